@@ -10,28 +10,72 @@
 # duplicating efforts.
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3Error
+from urllib3.util.retry import Retry
 import os
-import re
-from bs4 import BeautifulSoup
+import shutil
+import sqlite3
+import time
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    lxml_html = None
+    from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import json
 from tqdm import tqdm
-import queue
 
 # Configuration
 BASE_REVERSION = "16"
 BASE_URL = f"https://www.3gpp.org/ftp/Specs/latest/Rel-{BASE_REVERSION}/"
 DOWNLOAD_DIR = f"data/Rel-{BASE_REVERSION}"
-STATE_FILE = f"download_state_rel-{BASE_REVERSION}.json"
+STATE_FILE = f"download_state_rel-{BASE_REVERSION}.db"
 MAX_THREADS = 7
+# Files larger than this are fetched as RANGE_PARTS parallel byte ranges
+RANGE_THRESHOLD = 8 << 20
+RANGE_PARTS = 4
+# Read/write chunk size for streamed downloads
+BLOCK_SIZE = 1024 * 1024
+# Number of recorded downloads per state database commit
+STATE_BATCH_SIZE = 16
+# Re-check previously downloaded files with conditional requests (ETag /
+# Last-Modified) and re-fetch only those that changed on the server
+REVALIDATE = False
 
-# Set a User-Agent to mimic a browser
+# Set a User-Agent to mimic a browser. The HTML listings are requested with the
+# default requests Accept-Encoding, which already covers gzip and deflate, and br
+# once brotli is installed
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
 
+# The .zip payloads are already compressed; request them as-is so Content-Length
+# and byte ranges refer to the bytes written to disk
+DOWNLOAD_HEADERS = {'Accept-Encoding': 'identity'}
+
+# Serializes state database writes from the download threads
+STATE_LOCK = threading.Lock()
+
+# Shared HTTP session so every request to the 3GPP server reuses pooled
+# keep-alive connections instead of doing a fresh TCP/TLS handshake.
+# The pool is sized so every download thread can run all RANGE_PARTS ranges
+# of a large file at once; pool_block caps connections at that number.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_THREADS * RANGE_PARTS,
+    pool_block=True,
+    max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Selects the href of every link ending in .zip from a parsed listing page
+if lxml_html is not None:
+    ZIP_HREFS = etree.XPath("//a[substring(@href, string-length(@href) - 3) = '.zip']/@href")
+
 # Hardcoded list of series directories based on your input
 SERIES_DIRS = [
     "21_series/", "22_series/", "23_series/", "24_series/", "25_series/",
@@ -42,71 +86,289 @@ SERIES_DIRS = [
     "51_series/", "52_series/", "55_series/"
 ]
 
+def fetch_series(series_dir):
+    """
+    Fetches the listing page of a single series directory.
+    Returns the page URL and the response, or None as the response if the fetch failed.
+    """
+    series_url = urljoin(BASE_URL, series_dir)
+    try:
+        response = SESSION.get(series_url)
+        response.raise_for_status()
+        return series_url, response
+    except requests.exceptions.RequestException as e:
+        print(f"\nCould not fetch {series_url}: {e}")
+        return series_url, None
+
+def parse_series(series_url, response):
+    """
+    Extracts all .zip file links from a fetched series listing page.
+    """
+    if lxml_html is not None:
+        try:
+            hrefs = ZIP_HREFS(lxml_html.fromstring(response.content))
+        except etree.ParserError:
+            # Empty, whitespace-only or comment-only pages have no document to parse
+            hrefs = []
+    else:
+        soup = BeautifulSoup(response.text, 'html.parser')
+        hrefs = [link['href'] for link in soup.find_all('a', href=True) if link['href'].endswith('.zip')]
+
+    return [urljoin(series_url, str(href)) for href in hrefs]
+
 def get_all_spec_files():
     """
-    Fetches all .zip file links by iterating through a hardcoded list of series directories.
+    Fetches all .zip file links from a hardcoded list of series directories.
+    The pages are fetched concurrently and parsed on this thread as each one arrives,
+    so parsing overlaps with the requests still in flight.
     """
     print(f"Fetching spec files from known Rel-{BASE_REVERSION} series directories...")
     all_spec_files = []
     
-    for series_dir in tqdm(SERIES_DIRS, desc="Scanning Series Dirs"):
-        series_url = urljoin(BASE_URL, series_dir)
-        try:
-            response = requests.get(series_url, headers=HEADERS)
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            for link in soup.find_all('a', href=re.compile(r'\.zip$')):
-                all_spec_files.append(urljoin(series_url, link['href']))
-                
-        except requests.exceptions.RequestException as e:
-            print(f"\nCould not fetch {series_url}: {e}")
+    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+        futures = [executor.submit(fetch_series, series_dir) for series_dir in SERIES_DIRS]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Scanning Series Dirs"):
+            series_url, response = future.result()
+            if response is not None:
+                all_spec_files.extend(parse_series(series_url, response))
 
     return sorted(list(set(all_spec_files)))
 
-def save_state(state):
-    """Saves the download state to a file."""
-    with open(STATE_FILE, 'w') as f:
-        json.dump(state, f, indent=4)
+def save_state(state, filepath, url, etag=None, last_modified=None):
+    """Records a downloaded file and its cache validators in the state database and in memory."""
+    with STATE_LOCK:
+        db = state["db"]
+        if not db.in_transaction:
+            db.execute("BEGIN")
+        db.execute(
+            "INSERT OR REPLACE INTO downloads(path, url, bytes, ts, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(filepath), url, filepath.stat().st_size, time.time(), etag, last_modified),
+        )
+        state["downloaded_files"][str(filepath)] = (etag, last_modified)
+        state["pending"] += 1
+        if state["pending"] >= STATE_BATCH_SIZE:
+            db.execute("COMMIT")
+            state["pending"] = 0
+
+def flush_state(state):
+    """Commits any downloads recorded since the last batch."""
+    with STATE_LOCK:
+        if state["db"].in_transaction:
+            state["db"].execute("COMMIT")
+        state["pending"] = 0
 
 def load_state():
-    """Loads the download state from a file."""
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            return json.load(f)
-    return {"downloaded_files": []}
+    """
+    Opens the SQLite state database and loads the downloaded files, mapped to
+    their (etag, last_modified) validators.
+    """
+    db = sqlite3.connect(STATE_FILE, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS downloads("
+        "path TEXT PRIMARY KEY, url TEXT, bytes INTEGER, ts REAL, etag TEXT, last_modified TEXT)"
+    )
+    # State databases from older versions lack the validator columns
+    columns = {row[1] for row in db.execute("PRAGMA table_info(downloads)")}
+    for column in ("etag", "last_modified"):
+        if column not in columns:
+            db.execute(f"ALTER TABLE downloads ADD COLUMN {column} TEXT")
+    downloaded_files = {
+        path: (etag, last_modified)
+        for path, etag, last_modified in db.execute("SELECT path, etag, last_modified FROM downloads")
+    }
+    return {"downloaded_files": downloaded_files, "db": db, "pending": 0}
+
+class ProgressWriter:
+    """Wraps a file so every write also advances a tqdm progress bar."""
+
+    def __init__(self, f, pbar):
+        self.f = f
+        self.pbar = pbar
 
-def download_file(url, state):
+    def write(self, data):
+        self.pbar.update(len(data))
+        return self.f.write(data)
+
+def copy_body(response, f, file_pbar):
     """
-    Downloads a single file and updates the state.
+    Copies a streamed response body into f. urllib3 errors from reading the raw stream
+    (dropped connections, short bodies, read timeouts) are re-raised as requests errors,
+    as iter_content would.
     """
-    filename = url.split('/')[-1]
-    series = url.split('/')[-2]
-    
-    series_dir = Path(DOWNLOAD_DIR) / series
-    series_dir.mkdir(parents=True, exist_ok=True)
-    
-    filepath = series_dir / filename
-    
-    if str(filepath) in state["downloaded_files"]:
-        return
+    response.raw.decode_content = True
+    try:
+        shutil.copyfileobj(response.raw, ProgressWriter(f, file_pbar), BLOCK_SIZE)
+    except Urllib3Error as e:
+        raise requests.exceptions.ConnectionError(e) from e
+
+def preallocate(f, size):
+    """Reserves disk space for a file of known size to reduce fragmentation."""
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f.truncate(size)
+
+def download_ranges(url, filepath, total_size, validator, file_pbar):
+    """
+    Downloads a file as RANGE_PARTS concurrent byte ranges, each written at its own offset.
+    Every range carries If-Range with the validator from the file's HEAD response, so the
+    ranges cannot be stitched together from two versions of a file that changed meanwhile.
+    Returns False if the server ignores the Range header or the file changed, so the caller
+    can fall back to a single-stream download.
+    """
+    part_size = -(-total_size // RANGE_PARTS)
+
+    # A preallocated file is no resumable prefix, so drop any validator saved for one
+    meta_path = filepath.with_name(filepath.name + '.meta')
+    if meta_path.exists():
+        meta_path.unlink()
+    with open(filepath, 'wb') as f:
+        preallocate(f, total_size)
 
+    def fetch_range(start):
+        end = min(start + part_size, total_size) - 1
+        headers = {**DOWNLOAD_HEADERS, 'Range': f'bytes={start}-{end}', 'If-Range': validator}
+        with SESSION.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                return False
+            with open(filepath, 'r+b') as f:
+                f.seek(start)
+                copy_body(response, f, file_pbar)
+                # The file is preallocated, so a short range would otherwise go unnoticed
+                if f.tell() != end + 1:
+                    raise requests.exceptions.ConnectionError(
+                        f"Range {start}-{end} ended after {f.tell() - start} of {end - start + 1} bytes"
+                    )
+        return True
+
+    with ThreadPoolExecutor(max_workers=RANGE_PARTS) as executor:
+        return all(list(executor.map(fetch_range, range(0, total_size, part_size))))
+
+def content_length(headers):
+    """Returns the Content-Length from headers as an int, or 0 if it is missing or malformed."""
     try:
-        response = requests.get(url, stream=True, headers=HEADERS)
+        return int(headers.get('content-length', 0))
+    except ValueError:
+        return 0
+
+def if_range_validator(headers):
+    """Returns the strong ETag, or failing that Last-Modified, usable as an If-Range value."""
+    etag = headers.get('etag')
+    # Weak ETags cannot be used with If-Range
+    return etag if etag and not etag.startswith('W/') else headers.get('last-modified')
+
+def resumable_validator(filepath, total_size):
+    """
+    Returns the validator saved in the .meta file next to filepath if filepath is a partial
+    download that can be resumed, or None if there is nothing to resume.
+    """
+    meta_path = filepath.with_name(filepath.name + '.meta')
+    # Ranged downloads preallocate the full size, so only a shorter file is a resumable prefix
+    if not meta_path.exists() or not filepath.exists() or not 0 < filepath.stat().st_size < total_size:
+        return None
+    return meta_path.read_text().strip() or None
+
+def download_stream(url, filepath, head, file_pbar):
+    """
+    Downloads a file over a single connection. The validator of the response is saved in
+    a .meta file next to filepath, so a partial file left by an interrupted run can be
+    resumed with a Range request guarded by If-Range: if the file changed on the server
+    since, it is fetched again from the start. Without a saved validator, a partial file
+    is never resumed. Returns the (etag, last_modified) validators of the downloaded body.
+    """
+    total_size = content_length(head.headers)
+    meta_path = filepath.with_name(filepath.name + '.meta')
+    saved_validator = resumable_validator(filepath, total_size)
+
+    headers = dict(DOWNLOAD_HEADERS)
+    resuming = head.headers.get('accept-ranges') == 'bytes' and saved_validator is not None
+    if resuming:
+        resume_from = filepath.stat().st_size
+        headers['Range'] = f'bytes={resume_from}-'
+        headers['If-Range'] = saved_validator
+
+    with SESSION.get(url, headers=headers, stream=True) as response:
         response.raise_for_status()
-        
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024
-        
-        with open(filepath, 'wb') as f, tqdm(
-            total=total_size, unit='iB', unit_scale=True, desc=filename, leave=False
+        resumed = resuming and response.status_code == 206
+        if not resumed:
+            validator = if_range_validator(response.headers)
+            if validator:
+                meta_path.write_text(validator)
+            elif meta_path.exists():
+                meta_path.unlink()
+        file_pbar.reset(total=total_size or content_length(response.headers))
+        if resumed:
+            file_pbar.update(resume_from)
+        with open(filepath, 'ab' if resumed else 'wb') as f:
+            copy_body(response, f, file_pbar)
+        return response.headers.get('etag'), response.headers.get('last-modified')
+
+def fetch_head(url, filepath, state):
+    """
+    Sends a HEAD request for a file, conditional on the validators recorded for an
+    already downloaded copy. Returns None if the server reports it unchanged.
+    """
+    headers = dict(DOWNLOAD_HEADERS)
+    validators = state["downloaded_files"].get(str(filepath))
+    if validators is not None and filepath.exists():
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    head = SESSION.head(url, headers=headers, allow_redirects=True)
+    head.raise_for_status()
+    return None if head.status_code == 304 else head
+
+def download_file(url, filepath, state, head=None):
+    """
+    Downloads a single file to filepath, whose directory must already exist, and updates the state.
+    head is the file's HEAD response if main() already fetched it. The body is written to a
+    .part file next to filepath and only renamed into place once complete. With REVALIDATE,
+    a previously downloaded file is only fetched again if the server reports that it changed.
+    """
+    if str(filepath) in state["downloaded_files"] and not REVALIDATE:
+        return
+
+    part_path = filepath.with_name(filepath.name + '.part')
+    try:
+        if head is None:
+            head = fetch_head(url, filepath, state)
+            if head is None:
+                return
+        total_size = content_length(head.headers)
+        accepts_ranges = head.headers.get('accept-ranges') == 'bytes'
+        # Ranges are only safe to combine if a validator ties them to one version of the file
+        validator = if_range_validator(head.headers)
+        validators = (head.headers.get('etag'), head.headers.get('last-modified'))
+
+        with tqdm(
+            total=total_size, unit='iB', unit_scale=True, desc=filepath.name, leave=False, mininterval=0.5
         ) as file_pbar:
-            for data in response.iter_content(block_size):
-                file_pbar.update(len(data))
-                f.write(data)
+            # Finishing a partial file from an earlier run beats fetching it again in ranges
+            use_ranges = (
+                accepts_ranges and validator and total_size > RANGE_THRESHOLD
+                and resumable_validator(part_path, total_size) is None
+            )
+            if not (use_ranges and download_ranges(url, part_path, total_size, validator, file_pbar)):
+                validators = download_stream(url, part_path, head, file_pbar)
 
-        state["downloaded_files"].append(str(filepath))
-        save_state(state)
+        # Keep an incomplete .part for the next run to resume rather than recording it
+        part_size = part_path.stat().st_size
+        if total_size and part_size != total_size:
+            print(f"\nIncomplete download of {url}: got {part_size} of {total_size} bytes")
+            return
+
+        # Rename before recording, so the state never lists a file that is not in place
+        os.replace(part_path, filepath)
+        meta_path = part_path.with_name(part_path.name + '.meta')
+        if meta_path.exists():
+            meta_path.unlink()
+        save_state(state, filepath, url, *validators)
 
     except requests.exceptions.RequestException as e:
         print(f"\nError downloading {url}: {e}")
@@ -114,51 +376,66 @@ def download_file(url, state):
         print(f"\nError writing to file {filepath}: {e}")
 
 
-def worker(url_queue, state, pbar):
-    """Worker thread for downloading files."""
-    while True:
-        try:
-            url = url_queue.get_nowait()
-            download_file(url, state)
-            url_queue.task_done()
-            pbar.update(1)
-        except queue.Empty:
-            break
-
 def main():
     """
     Main function to orchestrate the download process.
     """
     Path(DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
     state = load_state()
+    try:
+        # Resolve DNS and open one pooled TLS connection before the threads fan out
+        try:
+            SESSION.head(BASE_URL, allow_redirects=True)
+        except requests.exceptions.RequestException as e:
+            print(f"\nCould not reach {BASE_URL}: {e}")
 
-    all_spec_files = get_all_spec_files()
+        all_spec_files = get_all_spec_files()
 
-    if not all_spec_files:
-        print("No specification files found to download. Exiting.")
-        return
+        if not all_spec_files:
+            print("No specification files found to download. Exiting.")
+            return
         
-    url_queue = queue.Queue()
-    # Filter out already downloaded files before adding to queue
-    files_to_download = [f for f in all_spec_files if str(Path(DOWNLOAD_DIR) / f.split('/')[-2] / f.split('/')[-1]) not in state["downloaded_files"]]
-    
-    for spec_file in files_to_download:
-        url_queue.put(spec_file)
+        # Filter out already downloaded files before scheduling, unless revalidating them
+        download_root = Path(DOWNLOAD_DIR)
+        downloaded_files = state["downloaded_files"]
+        files_to_download = []
+        for spec_file in all_spec_files:
+            filepath = download_root.joinpath(*spec_file.rsplit('/', 2)[-2:])
+            if REVALIDATE or str(filepath) not in downloaded_files:
+                files_to_download.append((spec_file, filepath))
+
+        # Create each series directory once up front rather than once per file
+        for series_dir in {filepath.parent for _, filepath in files_to_download}:
+            series_dir.mkdir(parents=True, exist_ok=True)
+
+        print(f"Found {len(all_spec_files)} total files, {len(files_to_download)} to download.")
 
-    print(f"Found {len(all_spec_files)} total files, {len(files_to_download)} to download.")
+        def probe(task):
+            spec_file, filepath = task
+            try:
+                return fetch_head(spec_file, filepath, state)
+            except requests.exceptions.RequestException as e:
+                print(f"\nError checking {spec_file}: {e}")
 
-    with tqdm(total=len(files_to_download), desc="Overall Progress") as pbar:
-        threads = []
-        for _ in range(MAX_THREADS):
-            thread = threading.Thread(target=worker, args=(url_queue, state, pbar))
-            thread.start()
-            threads.append(thread)
+        # Fetch every file's size up front and start the largest first, so one big
+        # straggler does not hold up the end of the run
+        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+            heads = list(tqdm(executor.map(probe, files_to_download), total=len(files_to_download), desc="Checking File Sizes"))
+        tasks = [(spec_file, filepath, head) for (spec_file, filepath), head in zip(files_to_download, heads) if head is not None]
+        tasks.sort(key=lambda task: content_length(task[2].headers), reverse=True)
 
-        url_queue.join()
+        with tqdm(total=len(tasks), desc="Overall Progress") as pbar, \
+                ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+            futures = {executor.submit(download_file, spec_file, filepath, state, head): spec_file for spec_file, filepath, head in tasks}
+            for future in as_completed(futures):
+                pbar.update(1)
+                future.result()
 
-    print("All downloads completed.")
-    if os.path.exists(STATE_FILE):
-        os.remove(STATE_FILE)
+        print("All downloads completed.")
+    finally:
+        flush_state(state)
+        # The state database is kept so later runs can skip or revalidate finished files
+        state["db"].close()
 
 if __name__ == "__main__":
     main()
@@ -10,116 +10,408 @@
 # duplicating efforts.
 
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
+import io
 import os
 import sys
-import json
+import shutil
 from pathlib import Path
 
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import ProtocolError
+
 # Add the parent directory to the path to allow importing the main script
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from src.main import get_latest_specs_links, get_spec_files_from_series, download_file, save_state, load_state
+import src.main as main
+from src.main import get_all_spec_files, parse_series, download_file, fetch_head, save_state, flush_state, load_state
+
+
+class FakeResponse:
+    """Minimal stand-in for a streamed requests.Response."""
+
+    def __init__(self, status_code=200, body=b'', headers=None, raw=None):
+        self.status_code = status_code
+        self.content = body
+        self.text = body.decode('latin-1')
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.raw = raw if raw is not None else io.BytesIO(body)
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FakeServer:
+    """Serves a single file with an ETag, honouring Range and If-Range like the 3GPP server."""
+
+    def __init__(self, body, etag='"v1"', ranges=True):
+        self.body = body
+        self.etag = etag
+        self.ranges = ranges
+        self.requests = []
+        self.head_requests = []
+
+    def head(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.head_requests.append(dict(headers))
+        status_code = 304 if headers.get('If-None-Match') == self.etag else 200
+        return FakeResponse(status_code, b'', {
+            'Content-Length': str(len(self.body)), 'ETag': self.etag, 'Accept-Ranges': 'bytes',
+        })
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(dict(headers))
+        range_header = headers.get('Range')
+        if self.ranges and range_header and headers.get('If-Range') in (None, self.etag):
+            start, _, end = range_header[len('bytes='):].partition('-')
+            start, end = int(start), int(end) if end else len(self.body) - 1
+            part = self.body[start:end + 1]
+            return FakeResponse(206, part, {'Content-Length': str(len(part)), 'ETag': self.etag})
+        return FakeResponse(200, self.body, {'Content-Length': str(len(self.body)), 'ETag': self.etag})
+
+
+class BrokenRaw(io.RawIOBase):
+    """Raw stream that drops the connection on the first read."""
+
+    def read(self, size=-1):
+        raise ProtocolError("Connection broken: IncompleteRead(10 bytes read, 990 more expected)")
+
 
 class Test3gppDownloader(unittest.TestCase):
 
     def setUp(self):
         """Set up test environment."""
-        self.base_url = "https://www.3gpp.org/ftp/Specs/latest"
+        self.base_url = "https://www.3gpp.org/ftp/Specs/latest/Rel-16"
         self.download_dir = "test_downloads"
-        self.state_file = "test_state.json"
-        
+        self.state_file = "test_state.db"
+        self.file_url = f"{self.base_url}/21_series/21101-g00.zip"
+        self.filepath = Path(self.download_dir) / "21_series" / "21101-g00.zip"
+        self.part_path = self.filepath.with_name(self.filepath.name + '.part')
+        self.meta_path = self.part_path.with_name(self.part_path.name + '.meta')
+
         # Override constants in main module
         self.patcher_download_dir = patch('src.main.DOWNLOAD_DIR', self.download_dir)
         self.patcher_state_file = patch('src.main.STATE_FILE', self.state_file)
         self.mock_download_dir = self.patcher_download_dir.start()
         self.mock_state_file = self.patcher_state_file.start()
 
-        Path(self.download_dir).mkdir(exist_ok=True)
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self.state = load_state()
 
     def tearDown(self):
         """Clean up test environment."""
-        if os.path.exists(self.download_dir):
-            for series_dir in os.listdir(self.download_dir):
-                series_path = os.path.join(self.download_dir, series_dir)
-                for f in os.listdir(series_path):
-                    os.remove(os.path.join(series_path, f))
-                os.rmdir(series_path)
-            os.rmdir(self.download_dir)
-        
-        if os.path.exists(self.state_file):
-            os.remove(self.state_file)
-            
+        self.state["db"].close()
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.state_file + suffix):
+                os.remove(self.state_file + suffix)
+
         self.patcher_download_dir.stop()
         self.patcher_state_file.stop()
 
-    @patch('src.main.requests.get')
-    def test_get_latest_specs_links(self, mock_get):
-        """Test fetching latest spec links."""
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.text = """
-        <html><body>
-            <a href="21-series/">21-series/</a>
-            <a href="22-series/">22-series/</a>
-            <a href="invalid/">invalid/</a>
-        </body></html>
-        """
-        mock_get.return_value = mock_response
-
-        links = get_latest_specs_links()
-        self.assertEqual(len(links), 2)
-        self.assertIn(f"{self.base_url}/21-series/", links)
-        self.assertIn(f"{self.base_url}/22-series/", links)
-
-    @patch('src.main.requests.get')
-    def test_get_spec_files_from_series(self, mock_get):
-        """Test fetching spec files from a series page."""
-        series_url = f"{self.base_url}/21-series/"
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.text = """
+    def download(self, server):
+        """Downloads self.file_url from a fake server, passing its HEAD response like main() does."""
+        with patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state, server.head(self.file_url))
+
+    def test_download_file(self):
+        """Test downloading a single file."""
+        self.download(FakeServer(b'file content'))
+
+        self.assertTrue(self.filepath.exists())
+        with open(self.filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'file content')
+        self.assertFalse(self.part_path.exists())
+        self.assertFalse(self.meta_path.exists())
+        self.assertEqual(self.state["downloaded_files"][str(self.filepath)], ('"v1"', None))
+
+    def test_resume_partial_file(self):
+        """Test resuming a .part file whose saved validator still matches the server."""
+        body = b'0123456789' * 100
+        self.part_path.write_bytes(body[:400])
+        self.meta_path.write_text('"v1"')
+        server = FakeServer(body, etag='"v1"')
+        self.download(server)
+
+        self.assertEqual(server.requests, [{'Accept-Encoding': 'identity', 'Range': 'bytes=400-', 'If-Range': '"v1"'}])
+        self.assertEqual(self.filepath.read_bytes(), body)
+
+    def test_resume_after_file_changed(self):
+        """Test that a .part of an older version is downloaded again instead of spliced."""
+        self.part_path.write_bytes(b'o' * 400)
+        self.meta_path.write_text('"v1"')
+        body = b'n' * 1000
+        server = FakeServer(body, etag='"v2"')
+        self.download(server)
+
+        self.assertEqual(server.requests[0]['If-Range'], '"v1"')
+        self.assertEqual(self.filepath.read_bytes(), body)
+        self.assertEqual(self.state["downloaded_files"][str(self.filepath)], ('"v2"', None))
+
+    def test_partial_file_without_validator(self):
+        """Test that a .part with no saved validator is not resumed."""
+        self.part_path.write_bytes(b'o' * 400)
+        body = b'n' * 1000
+        server = FakeServer(body)
+        self.download(server)
+
+        self.assertNotIn('Range', server.requests[0])
+        self.assertEqual(self.filepath.read_bytes(), body)
+
+    def test_truncated_body(self):
+        """Test that a body shorter than its Content-Length is kept as .part and not recorded."""
+        head = FakeResponse(200, b'', {'Content-Length': '1000', 'ETag': '"v1"', 'Accept-Ranges': 'bytes'})
+        response = FakeResponse(200, b'x' * 10, {'Content-Length': '1000', 'ETag': '"v1"'})
+        with patch.object(main.SESSION, 'get', return_value=response):
+            download_file(self.file_url, self.filepath, self.state, head)
+
+        self.assertFalse(self.filepath.exists())
+        self.assertEqual(self.part_path.read_bytes(), b'x' * 10)
+        self.assertNotIn(str(self.filepath), self.state["downloaded_files"])
+
+    def test_parse_series(self):
+        """Test extracting spec files from a series page."""
+        series_url = f"{self.base_url}/21_series/"
+        response = FakeResponse(200, b"""
         <html><body>
             <a href="21101-g00.zip">21101-g00.zip</a>
             <a href="21905-g00.zip">21905-g00.zip</a>
             <a href="not_a_zip.txt">not_a_zip.txt</a>
         </body></html>
-        """
-        mock_get.return_value = mock_response
+        """)
 
-        files = get_spec_files_from_series(series_url)
+        files = parse_series(series_url, response)
         self.assertEqual(len(files), 2)
         self.assertIn(f"{series_url}21101-g00.zip", files)
         self.assertIn(f"{series_url}21905-g00.zip", files)
 
-    @patch('src.main.requests.get')
-    def test_download_file(self, mock_get):
-        """Test downloading a single file."""
-        file_url = f"{self.base_url}/21-series/21101-g00.zip"
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.iter_content.return_value = [b'file content']
-        mock_get.return_value = mock_response
-
-        state = {"downloaded_files": []}
-        download_file(file_url, state)
-
-        series_dir = Path(self.download_dir) / "21-series"
-        filepath = series_dir / "21101-g00.zip"
-        
-        self.assertTrue(filepath.exists())
-        with open(filepath, 'rb') as f:
-            self.assertEqual(f.read(), b'file content')
-        
-        self.assertIn(str(filepath), state["downloaded_files"])
+    def test_parse_series_empty_page(self):
+        """Test that pages with no document yield no links instead of raising."""
+        for body in (b"", b"   \n", b"<!-- no listing -->"):
+            self.assertEqual(parse_series(f"{self.base_url}/21_series/", FakeResponse(200, body)), [])
+
+    @patch('src.main.SERIES_DIRS', ["21_series/", "22_series/"])
+    def test_get_all_spec_files(self):
+        """Test collecting spec files from every series directory."""
+        def get(url, **kwargs):
+            series = url.rstrip('/').split('/')[-1][:2]
+            return FakeResponse(200, f"""
+            <html><body>
+                <a href="{series}101-g00.zip">{series}101-g00.zip</a>
+                <a href="not_a_zip.txt">not_a_zip.txt</a>
+            </body></html>
+            """.encode())
+
+        with patch.object(main.SESSION, 'get', side_effect=get):
+            files = get_all_spec_files()
+
+        self.assertEqual(files, [
+            f"{self.base_url}/21_series/21101-g00.zip",
+            f"{self.base_url}/22_series/22101-g00.zip",
+        ])
 
     def test_save_and_load_state(self):
-        """Test saving and loading the download state."""
-        state = {"downloaded_files": ["path/to/file1.zip", "path/to/file2.zip"]}
-        save_state(state)
-        
-        loaded_state = load_state()
-        self.assertEqual(state, loaded_state)
+        """Test saving, flushing and loading the download state."""
+        self.filepath.write_bytes(b'file content')
+        save_state(self.state, self.filepath, self.file_url, '"v1"', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        flush_state(self.state)
+        self.state["db"].close()
+
+        self.state = load_state()
+        self.assertEqual(self.state["downloaded_files"], {
+            str(self.filepath): ('"v1"', 'Mon, 01 Jan 2024 00:00:00 GMT'),
+        })
+
+    def test_connection_dropped(self):
+        """Test that a connection dropped mid-body is reported rather than raised."""
+        head = FakeResponse(200, b'', {'Content-Length': '1000'})
+        response = FakeResponse(200, headers={'Content-Length': '1000'}, raw=BrokenRaw())
+        with patch.object(main.SESSION, 'get', return_value=response):
+            download_file(self.file_url, self.filepath, self.state, head)
+
+        self.assertFalse(self.filepath.exists())
+        self.assertNotIn(str(self.filepath), self.state["downloaded_files"])
+
+    @patch('src.main.RANGE_THRESHOLD', 100)
+    def test_download_file_in_ranges(self):
+        """Test downloading a large file as parallel byte ranges."""
+        body = bytes(range(256)) * 4
+        server = FakeServer(body)
+        self.download(server)
+
+        self.assertEqual(self.filepath.read_bytes(), body)
+        self.assertEqual(len(server.requests), main.RANGE_PARTS)
+        self.assertIn(str(self.filepath), self.state["downloaded_files"])
+
+    @patch('src.main.RANGE_THRESHOLD', 100)
+    def test_download_file_range_ignored(self):
+        """Test falling back to a single stream when the server answers a Range request with 200."""
+        body = bytes(range(256)) * 4
+        server = FakeServer(body, ranges=False)
+        self.download(server)
+
+        self.assertEqual(self.filepath.read_bytes(), body)
+        self.assertNotIn('Range', server.requests[-1])
+        self.assertIn(str(self.filepath), self.state["downloaded_files"])
+
+    @patch('src.main.RANGE_THRESHOLD', 100)
+    def test_download_file_in_ranges_changed(self):
+        """Test that ranges of a file replaced after its HEAD are not stitched from two versions."""
+        server = FakeServer(b'o' * 1000, etag='"v1"')
+        head = server.head(self.file_url)
+        server.body, server.etag = b'n' * 1000, '"v2"'
+        with patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state, head)
+
+        self.assertTrue(all(request['If-Range'] == '"v1"' for request in server.requests if 'Range' in request))
+        self.assertEqual(self.filepath.read_bytes(), b'n' * 1000)
+        self.assertEqual(self.state["downloaded_files"][str(self.filepath)], ('"v2"', None))
+
+    @patch('src.main.RANGE_THRESHOLD', 100)
+    def test_download_file_in_ranges_without_validator(self):
+        """Test that a file without an ETag or Last-Modified is not split into ranges."""
+        server = FakeServer(b'x' * 1000, etag=None)
+        head = FakeResponse(200, b'', {'Content-Length': '1000', 'Accept-Ranges': 'bytes'})
+        with patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state, head)
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertNotIn('Range', server.requests[0])
+        self.assertEqual(self.filepath.read_bytes(), b'x' * 1000)
+
+    def test_save_state_commits_in_batches(self):
+        """Test that every STATE_BATCH_SIZE recorded files are committed without a flush."""
+        for i in range(main.STATE_BATCH_SIZE + 1):
+            filepath = self.filepath.with_name(f"{i}.zip")
+            filepath.write_bytes(b'file content')
+            save_state(self.state, filepath, f"{self.file_url}{i}")
+
+        # A second connection only sees committed rows, as a restart after a hard kill would
+        reloaded = load_state()
+        self.addCleanup(reloaded["db"].close)
+        self.assertEqual(len(reloaded["downloaded_files"]), main.STATE_BATCH_SIZE)
+        self.assertNotIn(str(self.filepath.with_name(f"{main.STATE_BATCH_SIZE}.zip")), reloaded["downloaded_files"])
+
+    def test_fetch_head_unchanged(self):
+        """Test that a recorded file is revalidated with its saved validators."""
+        self.filepath.write_bytes(b'file content')
+        self.state["downloaded_files"][str(self.filepath)] = ('"v1"', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        with patch.object(main.SESSION, 'head', return_value=FakeResponse(304)) as mock_head:
+            self.assertIsNone(fetch_head(self.file_url, self.filepath, self.state))
+
+        headers = mock_head.call_args.kwargs['headers']
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'], 'Mon, 01 Jan 2024 00:00:00 GMT')
+
+    @patch('src.main.REVALIDATE', True)
+    def test_revalidate_changed_file(self):
+        """Test that revalidation replaces a file that changed on the server and records its new validators."""
+        self.filepath.write_bytes(b'old content')
+        self.state["downloaded_files"][str(self.filepath)] = ('"v1"', None)
+        server = FakeServer(b'new content', etag='"v2"')
+        with patch.object(main.SESSION, 'head', side_effect=server.head), \
+                patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state)
+
+        self.assertEqual(server.head_requests[0]['If-None-Match'], '"v1"')
+        self.assertEqual(self.filepath.read_bytes(), b'new content')
+        self.assertEqual(self.state["downloaded_files"][str(self.filepath)], ('"v2"', None))
+
+    @patch('src.main.REVALIDATE', True)
+    def test_revalidate_unchanged_file(self):
+        """Test that revalidation leaves a file alone when the server answers 304."""
+        self.filepath.write_bytes(b'file content')
+        self.state["downloaded_files"][str(self.filepath)] = ('"v1"', None)
+        server = FakeServer(b'file content', etag='"v1"')
+        with patch.object(main.SESSION, 'head', side_effect=server.head), \
+                patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state)
+
+        self.assertEqual(server.requests, [])
+        self.assertEqual(self.filepath.read_bytes(), b'file content')
+
+    @patch('src.main.RANGE_THRESHOLD', 100)
+    def test_resume_partial_file_above_range_threshold(self):
+        """Test that a partial file above RANGE_THRESHOLD is resumed rather than fetched again in ranges."""
+        body = bytes(range(250)) * 4
+        self.part_path.write_bytes(body[:400])
+        self.meta_path.write_text('"v1"')
+        server = FakeServer(body)
+        with patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state, server.head(self.file_url))
+
+        self.assertEqual(server.requests, [{'Accept-Encoding': 'identity', 'Range': 'bytes=400-', 'If-Range': '"v1"'}])
+        self.assertEqual(self.filepath.read_bytes(), body)
+        self.assertFalse(self.meta_path.exists())
+
+    def test_download_file_malformed_content_length(self):
+        """Test that a malformed Content-Length is treated as unknown instead of aborting the download."""
+        server = FakeServer(b'file content')
+        head = FakeResponse(200, b'', {'Content-Length': 'abc', 'ETag': '"v1"', 'Accept-Ranges': 'bytes'})
+        with patch.object(main.SESSION, 'get', side_effect=server.get):
+            download_file(self.file_url, self.filepath, self.state, head)
+
+        self.assertEqual(self.filepath.read_bytes(), b'file content')
+        self.assertIn(str(self.filepath), self.state["downloaded_files"])
+
+    def record_done_file(self):
+        """Records 21_series/done.zip as downloaded, as an earlier run would have."""
+        filepath = Path(main.DOWNLOAD_DIR, '21_series', 'done.zip')
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_bytes(b'file content')
+        save_state(self.state, filepath, f"{self.base_url}/21_series/done.zip")
+        flush_state(self.state)
+
+    def run_main(self, sizes):
+        """Runs main() against spec files of the given Content-Length values, returning the HEADs sent and the files downloaded in order."""
+        spec_files = [f"{self.base_url}/21_series/{name}" for name in sizes]
+        probed, downloaded = [], []
+
+        def head(url, headers=None, **kwargs):
+            name = url.rsplit('/', 1)[-1]
+            if url in spec_files:
+                probed.append(name)
+            size = sizes.get(name, '0')
+            if size is None:
+                raise requests.exceptions.ConnectionError("connection refused")
+            return FakeResponse(304 if size == 304 else 200, b'', {'Content-Length': str(size)})
+
+        with patch('src.main.get_all_spec_files', return_value=spec_files), \
+                patch('src.main.MAX_THREADS', 1), \
+                patch.object(main.SESSION, 'head', side_effect=head), \
+                patch('src.main.download_file', side_effect=lambda url, *args: downloaded.append(url.rsplit('/', 1)[-1])):
+            main.main()
+        return probed, downloaded
+
+    def test_main_downloads_largest_first(self):
+        """Test that main() skips recorded, unreachable and unchanged files and starts the largest first."""
+        self.record_done_file()
+        sizes = {
+            'small.zip': 10, 'big.zip': 3000, 'bad.zip': 'abc', 'mid.zip': 500,
+            'broken.zip': None, 'same.zip': 304, 'done.zip': 20,
+        }
+        probed, downloaded = self.run_main(sizes)
+
+        self.assertNotIn('done.zip', probed)
+        self.assertEqual(downloaded, ['big.zip', 'mid.zip', 'small.zip', 'bad.zip'])
+
+    @patch('src.main.REVALIDATE', True)
+    def test_main_revalidates_recorded_files(self):
+        """Test that main() probes recorded files again with REVALIDATE."""
+        self.record_done_file()
+        probed, downloaded = self.run_main({'small.zip': 10, 'done.zip': 20})
+
+        self.assertIn('done.zip', probed)
+        self.assertEqual(downloaded, ['done.zip', 'small.zip'])
 
 if __name__ == '__main__':
     unittest.main()